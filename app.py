@@ -1,45 +1,192 @@
+import os
+import re
+import shutil
+from pathlib import Path
+
 import streamlit as st
-from pdfminer.high_level import extract_text
-from transformers import pipeline, set_seed
-import io
+import pypdfium2 as pdfium
+from optimum.onnxruntime import (
+    ORTModelForCausalLM,
+    ORTModelForQuestionAnswering,
+    ORTModelForSeq2SeqLM,
+    ORTOptimizer,
+    ORTQuantizer,
+)
+from optimum.onnxruntime.configuration import AutoOptimizationConfig, AutoQuantizationConfig
+import onnxruntime
+from rank_bm25 import BM25Okapi
+import torch
+from transformers import AutoTokenizer, pipeline, set_seed
 
 # --- Configuration ---
 # Models can be heavy, so load them once and cache them.
 # The 'st.cache_resource' decorator is suitable for objects that should be reused across sessions.
 
+# Exported and INT8-quantized ONNX models are written here so the export only happens once.
+ONNX_MODEL_DIR = Path("onnx_models")
+
+# Questions are answered from the best-matching windows of the document rather than just its beginning.
+RETRIEVAL_CHUNK_SIZE = 256 # QA tokenizer tokens per window
+RETRIEVAL_CHUNK_OVERLAP = 32 # Tokens shared by consecutive windows
+RETRIEVAL_TOP_K = 3 # Windows passed to the QA model per question
+MAX_QUESTION_TOKENS = 64 # Longer questions are truncated so every window fits the model's input
+MAX_ANSWER_TOKENS = 15 # Same default answer length limit as the question-answering pipeline
+
+# Long documents are summarized chunk by chunk; ~3500 characters is roughly DistilBART's 1024-token input limit.
+SUMMARY_CHUNK_SIZE = 3500 # Characters per chunk
+SUMMARY_CHUNK_OVERLAP = 500 # Characters shared by consecutive chunks
+SUMMARY_BATCH_SIZE = 8 # Chunks per forward pass, bounding memory on very long documents
+
+def load_quantized_model(model_class, model_name):
+    """
+    Loads a graph-optimized, INT8 dynamically-quantized ONNX Runtime version of a Hugging Face model.
+    The exported graph first goes through ONNX Runtime's O3 graph fusions (attention, LayerNorm, GELU)
+    and is then quantized.
+    """
+    save_dir = ONNX_MODEL_DIR / f"{model_name.replace('/', '__')}-o3-int8"
+    if not save_dir.exists():
+        export_dir = ONNX_MODEL_DIR / f"{save_dir.name}.fp32"
+        partial_dir = ONNX_MODEL_DIR / f"{save_dir.name}.partial"
+        model = model_class.from_pretrained(model_name, export=True)
+        optimizer = ORTOptimizer.from_pretrained(model)
+        optimizer.optimize(save_dir=export_dir, optimization_config=AutoOptimizationConfig.O3())
+
+        # Dynamic quantization needs no calibration data; the VNNI config uses int8 GEMMs on CPUs that support them
+        quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        # Seq2seq exports are split into encoder/decoder graphs, each quantized on its own
+        for onnx_file in export_dir.glob("*.onnx"):
+            quantizer = ORTQuantizer.from_pretrained(export_dir, file_name=onnx_file.name)
+            quantizer.quantize(save_dir=partial_dir, quantization_config=quantization_config)
+        for config_file in export_dir.glob("*.json"):
+            if not (partial_dir / config_file.name).exists():
+                shutil.copy(config_file, partial_dir)
+
+        shutil.rmtree(export_dir)
+        partial_dir.rename(save_dir)
+
+    # Let ONNX Runtime use every core for the matmuls inside a single forward pass
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = os.cpu_count()
+
+    quantized_files = {
+        re.sub(r"_optimized_quantized\.onnx$", "", f.name): f.name for f in save_dir.glob("*_optimized_quantized.onnx")
+    }
+    if model_class is ORTModelForSeq2SeqLM:
+        return model_class.from_pretrained(
+            save_dir,
+            encoder_file_name=quantized_files["encoder_model"],
+            decoder_file_name=quantized_files["decoder_model"],
+            decoder_with_past_file_name=quantized_files.get("decoder_with_past_model"),
+            session_options=session_options,
+        )
+    # Decoder-only exports may contain several graphs; prefer the single merged "model.onnx" when present
+    file_name = quantized_files.get("model", next(iter(quantized_files.values())))
+    return model_class.from_pretrained(save_dir, file_name=file_name, session_options=session_options)
+
+# ONNX Runtime model class used for each pipeline task
+ORT_MODEL_CLASSES = {
+    "summarization": ORTModelForSeq2SeqLM,
+    "question-answering": ORTModelForQuestionAnswering,
+    "text-generation": ORTModelForCausalLM,
+}
+
+@st.cache_resource
+def load_tokenizer(model_name):
+    """Loads a tokenizer. Cached separately so it is shared by every pipeline built on the same checkpoint."""
+    return AutoTokenizer.from_pretrained(model_name)
+
+@st.cache_resource
+def load_model_only(model_name, task):
+    """Loads the graph-optimized, quantized model weights for a task, without a tokenizer."""
+    # DistilBERT, DistilBART and GPT-2 all use the standard attention blocks that ONNX Runtime fuses
+    return load_quantized_model(ORT_MODEL_CLASSES[task], model_name)
+
 @st.cache_resource
 def load_summarizer_model():
     """Loads the summarization pipeline."""
     # Using a smaller model for faster loading times
-    return pipeline("summarization", model="sshleifer/distilbart-cnn-12-6", framework="pt")
+    model_name = "sshleifer/distilbart-cnn-12-6"
+    return pipeline(
+        "summarization",
+        model=load_model_only(model_name, "summarization"),
+        tokenizer=load_tokenizer(model_name),
+        framework="pt",
+    )
 
 @st.cache_resource
 def load_qa_model():
     """Loads the question-answering pipeline."""
     # Using a smaller, optimized model for QA
-    return pipeline("question-answering", model="distilbert/distilbert-base-uncased-distilled-squad", framework="pt")
+    model_name = "distilbert/distilbert-base-uncased-distilled-squad"
+    return pipeline(
+        "question-answering",
+        model=load_model_only(model_name, "question-answering"),
+        tokenizer=load_tokenizer(model_name),
+        framework="pt",
+    )
 
 @st.cache_resource
 def load_question_generator_model():
     """Loads the text generation pipeline for question generation."""
     # GPT-2 is used for demonstration; larger models would be better.
     # Set pad_token_id to eos_token_id to suppress warnings about padding token.
-    generator = pipeline("text-generation", model="gpt2")
+    generator = pipeline(
+        "text-generation",
+        model=load_model_only("gpt2", "text-generation"),
+        tokenizer=load_tokenizer("gpt2"),
+    )
     generator.model.config.pad_token_id = generator.tokenizer.eos_token_id
     return generator
 
+@st.cache_resource
+def configure_torch_threads():
+    """Uses every core within an op and a single inter-op thread to avoid oversubscription. Runs once per process."""
+    # set_num_interop_threads may only be called once, before any parallel work, hence the cache.
+    # Clearing Streamlit's resource cache runs this again, so a repeat call must not take the app down.
+    torch.set_num_threads(os.cpu_count())
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass # Already set earlier in this process
+
+@st.cache_resource
+def warm_up_models(_summarizer, _qa_model, _question_generator):
+    """Runs one tiny forward pass through each pipeline so the first real request only pays inference cost."""
+    # Leading underscores tell Streamlit not to hash the pipelines; warm-up happens once per process
+    _summarizer("warmup text " * 20, max_length=20, min_length=5)
+    _qa_model(question="q", context="a b c")
+    _question_generator("hi", max_new_tokens=4)
+
 # Load models outside the main app loop
+configure_torch_threads()
 summarizer = load_summarizer_model()
 qa_model = load_qa_model()
 question_generator = load_question_generator_model()
+warm_up_models(summarizer, qa_model, question_generator)
 
 # --- Utility Functions ---
 
+# Bound the extracted-text cache so a long-running server doesn't keep every uploaded PDF forever
+@st.cache_data(show_spinner=False, max_entries=64, ttl=24 * 60 * 60)
+def extract_pdf_bytes_text(pdf_bytes):
+    """Extracts text from raw PDF bytes. Cached on the bytes so re-uploads skip re-parsing."""
+    # pypdfium2 wraps the native PDFium parser, which is much faster than pure-Python extractors
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        pages_text = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            pages_text.append(textpage.get_text_range())
+            textpage.close()
+            page.close()
+        return "\n".join(pages_text)
+    finally:
+        pdf.close()
+
 def extract_pdf_text(uploaded_file):
     """Extracts text from a PDF file."""
     try:
-        # pdfminer.six expects a file-like object, so pass the BytesIO object
-        return extract_text(io.BytesIO(uploaded_file.getvalue()))
+        return extract_pdf_bytes_text(uploaded_file.getvalue())
     except Exception as e:
         st.error(f"Error extracting text from PDF: {e}")
         return None
@@ -55,89 +202,218 @@ def process_uploaded_document(uploaded_file):
         return None
     return text
 
+@st.cache_data(show_spinner=False, max_entries=16)
+def summarize_text(text):
+    """
+    Summarizes text of any length. Cached on the text, since Streamlit reruns the upload section on every interaction.
+    """
+    # The summarizer takes at most 1024 tokens, so split long text into overlapping windows of roughly
+    # that size, summarize them together in batches and repeat on the joined summaries until they fit one window.
+    step = SUMMARY_CHUNK_SIZE - SUMMARY_CHUNK_OVERLAP
+    while len(text) > SUMMARY_CHUNK_SIZE:
+        chunks = [text[i:i + SUMMARY_CHUNK_SIZE] for i in range(0, len(text) - SUMMARY_CHUNK_OVERLAP, step)]
+        chunk_summaries = summarizer(
+            chunks,
+            max_length=100,
+            min_length=30,
+            do_sample=False,
+            truncation=True,
+            batch_size=min(len(chunks), SUMMARY_BATCH_SIZE),
+        )
+        text = " ".join(chunk_summary["summary_text"] for chunk_summary in chunk_summaries)
+
+    # Final pass to get a single concise overview
+    summary = summarizer(text, max_length=150, min_length=50, do_sample=False, truncation=True)
+    return summary[0]["summary_text"]
+
 def generate_summary(text):
     """Generates a concise summary of the text."""
     if not text:
         return "Cannot generate summary for empty content."
     try:
-        # Truncate text if it's too long for the summarizer model (typically max 1024 tokens)
-        # For simplicity, we'll just take the first N characters. A proper solution would use chunking.
-        max_input_length = 1000 # Approximation, depends on model tokenizer
-        truncated_text = text[:max_input_length] if len(text) > max_input_length else text
-
-        summary = summarizer(truncated_text, max_length=150, min_length=50, do_sample=False)
-        return summary[0]["summary_text"]
+        # Errors are handled here rather than in the cached function so failures are not cached
+        return summarize_text(text)
     except Exception as e:
         st.error(f"Error generating summary: {e}")
         return "Summary generation failed."
 
+def tokenize_for_retrieval(text):
+    """Lowercases and splits text into word tokens for BM25 scoring."""
+    return re.findall(r"\w+", text.lower())
+
+def build_document_index(document_text):
+    """
+    Tokenizes the document once with the QA tokenizer, splits the tokens into overlapping windows
+    and builds a BM25 index over the windows' text.
+    """
+    encoding = qa_model.tokenizer(
+        document_text, add_special_tokens=False, return_offsets_mapping=True, truncation=False, verbose=False
+    )
+    token_ids = encoding["input_ids"]
+    step = RETRIEVAL_CHUNK_SIZE - RETRIEVAL_CHUNK_OVERLAP
+    # Each chunk is stored as a (first, last + 1) token range; the offset mapping converts it back to document characters
+    chunk_ranges = []
+    if token_ids:
+        for i in range(0, max(len(token_ids) - RETRIEVAL_CHUNK_OVERLAP, 1), step):
+            chunk_ranges.append((i, min(i + RETRIEVAL_CHUNK_SIZE, len(token_ids))))
+    offsets = encoding["offset_mapping"]
+    chunk_texts = [document_text[offsets[first][0]:offsets[last - 1][1]] for first, last in chunk_ranges]
+    corpus = [tokenize_for_retrieval(text) for text in chunk_texts]
+    # BM25Okapi divides by the corpus length, so a document with no word tokens at all (e.g. only symbols) gets no index
+    bm25 = BM25Okapi(corpus) if any(corpus) else None
+    return {
+        "text": document_text,
+        "token_ids": token_ids,
+        "offsets": offsets,
+        "word_ids": encoding.word_ids(), # Lets answer spans be widened to whole words
+        "chunk_ranges": chunk_ranges,
+        "bm25": bm25,
+    }
+
+def get_document_index(document_text):
+    """Returns the retrieval index for the document, building it once per document and keeping it in session state."""
+    index = st.session_state.get('document_index')
+    if index is None or index["text"] != document_text:
+        index = build_document_index(document_text)
+        st.session_state['document_index'] = index
+    return index
+
 def answer_question(context, question):
-    """Answers a question based on the provided context."""
+    """
+    Answers a question based on the provided context.
+    The most relevant windows of the context are retrieved with BM25 and run through the QA model as one batch,
+    reusing the context's cached tokenization. The best answer span is returned with "start"/"end" offsets
+    into the full context.
+    """
     if not context or not question:
         return {"answer": "Please upload a document and ask a question.", "score": 0.0}
     try:
-        # QA models also have context limits. For a real app, use RAG.
-        max_context_length = 500 # Approximate, depends on model tokenizer
-        truncated_context = context[:max_context_length] + "..." if len(context) > max_context_length else context
-        
-        answer = qa_model(question=question, context=truncated_context)
-        return answer
+        index = get_document_index(context)
+        if index["bm25"] is None:
+            return {"answer": "No answer found in the document.", "score": 0.0}
+
+        top_chunks = index["bm25"].get_top_n(
+            tokenize_for_retrieval(question), list(range(len(index["chunk_ranges"]))), n=RETRIEVAL_TOP_K
+        )
+        tokenizer = qa_model.tokenizer
+        question_ids = tokenizer(question, add_special_tokens=False)["input_ids"][:MAX_QUESTION_TOKENS]
+        # [CLS] question [SEP] context [SEP]: the window's tokens start right after the first [SEP]
+        context_start = len(tokenizer.build_inputs_with_special_tokens(question_ids, [])) - 1
+        windows = [index["token_ids"][first:last] for first, last in (index["chunk_ranges"][c] for c in top_chunks)]
+        sequences = [tokenizer.build_inputs_with_special_tokens(question_ids, window) for window in windows]
+        # Pad by hand: the ids are already built, and tokenizer.pad would warn on every call for fast tokenizers
+        batch_length = max(len(sequence) for sequence in sequences)
+        input_ids = torch.tensor(
+            [sequence + [tokenizer.pad_token_id] * (batch_length - len(sequence)) for sequence in sequences]
+        )
+        attention_mask = torch.tensor(
+            [[1] * len(sequence) + [0] * (batch_length - len(sequence)) for sequence in sequences]
+        )
+        with torch.no_grad():
+            outputs = qa_model.model(input_ids=input_ids, attention_mask=attention_mask)
+
+        best = {"score": -1.0}
+        for row, (chunk, window) in enumerate(zip(top_chunks, windows)):
+            context_end = context_start + len(window)
+            start_probs = outputs.start_logits[row, context_start:context_end].softmax(-1)
+            end_probs = outputs.end_logits[row, context_start:context_end].softmax(-1)
+            # Score every (start, end) pair with end >= start and at most MAX_ANSWER_TOKENS long
+            span_scores = torch.outer(start_probs, end_probs).triu().tril(MAX_ANSWER_TOKENS - 1)
+            best_flat = int(span_scores.argmax())
+            score = float(span_scores.flatten()[best_flat])
+            if score > best["score"]:
+                first_token = index["chunk_ranges"][chunk][0]
+                start_token, end_token = (first_token + t for t in divmod(best_flat, len(window)))
+                # Like the pipeline's align_to_words, widen the span so it never starts or ends mid-word
+                word_ids = index["word_ids"]
+                while start_token > 0 and word_ids[start_token - 1] == word_ids[start_token]:
+                    start_token -= 1
+                while end_token + 1 < len(word_ids) and word_ids[end_token + 1] == word_ids[end_token]:
+                    end_token += 1
+                start = index["offsets"][start_token][0]
+                end = index["offsets"][end_token][1]
+                best = {"answer": context[start:end], "score": score, "start": start, "end": end}
+        return best
     except Exception as e:
         st.error(f"Error answering question: {e}")
         return {"answer": "Could not answer the question.", "score": 0.0}
 
-def generate_logic_questions(document_text, num_questions=3):
+# Messages put in place of a question when generation fails; these are not real questions and are never answered
+PLACEHOLDER_QUESTION_PREFIXES = (
+    "Please upload a document to generate questions",
+    "Could not generate a meaningful question",
+    "Failed to generate question",
+)
+
+def is_placeholder_question(question):
+    """Returns True for the messages generate_logic_questions returns in place of a question."""
+    return question.startswith(PLACEHOLDER_QUESTION_PREFIXES)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def generate_questions_from_snippet(context_snippet, num_questions, seed):
+    """
+    Generates questions for a document snippet.
+    Generation is seeded, so the output only depends on the arguments and repeated requests are served from the cache.
+    """
+    questions = []
+    set_seed(seed) # for reproducibility of generation
+
+    prompt = f"Based on the following document snippet, generate a challenging comprehension or logic-based question:\n\n{context_snippet}\n\nQuestion:"
+    # The prompt is identical for every question, so generate all of them in one call:
+    # the prompt is encoded once and only the sampled continuations branch per sequence.
+    # max_new_tokens controls the length of the generated question
+    generations = question_generator(
+        prompt,
+        max_new_tokens=50,
+        num_return_sequences=num_questions,
+        do_sample=True,
+        return_full_text=False,
+    )
+
+    for i, generation in enumerate(generations):
+        # Simple post-processing to extract a plausible question
+        question_text = generation['generated_text'].strip()
+        # Try to stop at a question mark or new line
+        if '?' in question_text:
+            question_text = question_text.split('?')[0] + '?'
+        elif '\n' in question_text:
+            question_text = question_text.split('\n')[0].strip()
+
+        if question_text and len(question_text) > 10: # Basic filter for meaningful questions
+            questions.append(question_text)
+        else:
+            questions.append(f"Could not generate a meaningful question {i+1}.")
+
+    return questions
+
+def generate_logic_questions(document_text, num_questions=3, seed=42):
     """Generates logic-based or comprehension questions from the document."""
     if not document_text:
         return ["Please upload a document to generate questions."]
-    
-    questions = []
-    set_seed(42) # for reproducibility of generation
-    
+
     # Take a snippet of the document to guide question generation
     # GPT-2 has a max input of 1024 tokens, so we need to be careful with context size.
     # For better results, you might need a more advanced question generation model or technique.
     prompt_context_length = min(len(document_text), 500) 
     context_snippet = document_text[:prompt_context_length]
-    
-    for i in range(num_questions):
-        prompt = f"Based on the following document snippet, generate a challenging comprehension or logic-based question:\n\n{context_snippet}\n\nQuestion:"
-        try:
-            # Generate text, then try to extract a single question
-            # Using num_return_sequences=1 to get one generation per call
-            # max_new_tokens controls the length of the generated question
-            generated_text = question_generator(prompt, max_new_tokens=50, num_return_sequences=1, do_sample=True)[0]['generated_text']
-            
-            # Simple post-processing to extract a plausible question
-            question_text = generated_text.replace(prompt, "").strip()
-            # Try to stop at a question mark or new line
-            if '?' in question_text:
-                question_text = question_text.split('?')[0] + '?'
-            elif '\n' in question_text:
-                question_text = question_text.split('\n')[0].strip()
-            
-            if question_text and len(question_text) > 10: # Basic filter for meaningful questions
-                questions.append(question_text)
-            else:
-                questions.append(f"Could not generate a meaningful question {i+1}.")
-                
-        except Exception as e:
-            st.warning(f"Error generating question {i+1}: {e}")
-            questions.append(f"Failed to generate question {i+1}.")
-            
-    return questions
 
-def evaluate_answer(user_answer, generated_question, document_context):
+    try:
+        # Errors are handled here rather than in the cached function so failures are not cached
+        return generate_questions_from_snippet(context_snippet, num_questions, seed)
+    except Exception as e:
+        st.warning(f"Error generating questions: {e}")
+        return [f"Failed to generate question {i+1}." for i in range(num_questions)]
+
+def evaluate_answer(user_answer, correct_qa_result, document_context):
     """
     Evaluates the user's answer against a 'correct' answer derived from the document.
+    `correct_qa_result` is the QA model's answer to the question, computed once when the question was generated.
     This is a simplified evaluation.
     """
-    if not user_answer or not generated_question or not document_context:
-        return "Please provide all necessary inputs for evaluation."
+    if not user_answer or not correct_qa_result or not document_context:
+        return "Please provide all necessary inputs for evaluation.", False
 
-    # Get the "correct" answer from the document using the QA model
-    # This acts as our ground truth
-    correct_qa_result = answer_question(document_context, generated_question)
+    # The QA model's answer from the document acts as our ground truth
     correct_answer_text = correct_qa_result.get("answer", "").strip()
 
     feedback = ""
@@ -190,6 +466,7 @@ if uploaded_file is not None:
     if document_text:
         st.success("Document uploaded and processed successfully!")
         st.session_state['document_text'] = document_text # Store in session state
+        get_document_index(document_text) # Build the retrieval index once per upload
         
         # --- Auto Summary ---
         st.subheader("Document Summary")
@@ -256,9 +533,22 @@ if st.session_state.get('document_text'):
     elif mode == "Challenge Me":
         st.subheader("Challenge Your Comprehension")
         
-        if 'generated_questions' not in st.session_state or st.button("Generate New Questions", key="generate_q_button"):
+        # Questions and their precomputed answers belong to one document; regenerate them when a different one is uploaded
+        questions_are_stale = st.session_state.get('questions_document_text') != st.session_state['document_text']
+        if questions_are_stale or st.button("Generate New Questions", key="generate_q_button"):
             with st.spinner("Generating challenges..."):
-                st.session_state['generated_questions'] = generate_logic_questions(st.session_state['document_text'])
+                # A new seed per request gives fresh questions; the first set in a session uses seed 42
+                st.session_state['question_seed'] = st.session_state.get('question_seed', 41) + 1
+                st.session_state['generated_questions'] = generate_logic_questions(
+                    st.session_state['document_text'], seed=st.session_state['question_seed']
+                )
+                # Answer each question once up front so evaluating an answer is just a comparison.
+                # Placeholder messages get None, which evaluate_answer treats as missing input.
+                st.session_state['question_answers'] = [
+                    None if is_placeholder_question(question) else answer_question(st.session_state['document_text'], question)
+                    for question in st.session_state['generated_questions']
+                ]
+                st.session_state['questions_document_text'] = st.session_state['document_text']
                 st.session_state['user_answers'] = [""] * len(st.session_state['generated_questions'])
                 st.session_state['evaluation_feedback'] = [""] * len(st.session_state['generated_questions'])
 
@@ -275,7 +565,7 @@ if st.session_state.get('document_text'):
                     with st.spinner("Evaluating your answer..."):
                         feedback, is_correct = evaluate_answer(
                             st.session_state['user_answers'][i],
-                            q,
+                            st.session_state['question_answers'][i],
                             st.session_state['document_text']
                         )
                         st.session_state['evaluation_feedback'][i] = feedback